@@ -27,10 +27,16 @@
 # TODO Should '1.*' be interpreted as '>=1.0' and '<2.0' instead of only the former?
 
 import os
+import sys
 import datetime
 import urllib.request
 import shutil
 import hashlib
+import array
+import mmap
+import struct
+import tempfile
+import timeit
 from bs4 import BeautifulSoup as bs
 
 
@@ -162,6 +168,22 @@ PACKAGES = ('transformers',
             'xmonad-utils')
 
 
+# Compact metadata snapshot of all written packages, kept in the repository
+# root next to the package directories
+SNAPSHOT_FILENAME = '.mkpkgbuild.snapshot'
+SNAPSHOT_MAGIC = b'MKPS'
+SNAPSHOT_VERSION = 1
+
+# magic, version, string count, package count, dependency count
+SNAPSHOT_HEADER = struct.Struct('=4sIIII')
+
+# pkgname, pkgver, pkgrel, first dependency, dependency count
+SNAPSHOT_RECORD_FIELDS = 5
+
+# Every section after the header is an array of 4 byte unsigned ints
+assert array.array('I').itemsize == 4
+
+
 class CancelledError(Exception): pass
 
 
@@ -594,12 +616,27 @@ def write_pkgbuild(date, repository, maintainer_name, maintainer_alias,
         fh.write(content)
     except EnvironmentError as err:
         print("\nERROR", err)
+        return
     else:
         print("\nSaved", filename)
     finally:
         if fh is not None:
             fh.close()
 
+    # Only once the PKGBUILD is closed, a rebuild may have to read it back
+    try:
+        update_snapshot(pkgname, pkgver, pkgrel, depends)
+    except EnvironmentError as err:
+        print("ERROR", err)
+    except ValueError as err:
+        # Unreadable snapshot, start over from the PKGBUILDs on disk
+        print("ERROR", err)
+        print("Rebuilding", SNAPSHOT_FILENAME)
+        try:
+            build_snapshot(os.listdir())
+        except (EnvironmentError, ValueError) as err:
+            print("ERROR", err)
+
 
 def write_install(date, repository, maintainer_name, maintainer_alias,
         maintainer_email, _hkgname, pkgname, pkgver, pkgrel, pkgdesc,
@@ -620,6 +657,291 @@ def write_install(date, repository, maintainer_name, maintainer_alias,
             fh.close()
 
 
+# Return the items of an array value, e.g. "'ghc=7.6.3-1' 'haskell-mtl'"
+def split_array(value):
+    if not value:
+        return []
+    return [v.strip('\'"') for v in value.split()]
+
+
+# Return name and version constraint of a dependency, e.g. 'haskell-mtl>=2.0'
+def split_dependency(dependency):
+    for i, c in enumerate(dependency):
+        if c in '<>=':
+            return dependency[:i], dependency[i:]
+    return dependency, ''
+
+
+# Snapshot layout (native byte order, every section 4-byte aligned):
+#   header      magic, version, string count, package count, dependency count
+#   offsets     string count + 1 unsigned ints into the string blob
+#   packages    package count records of SNAPSHOT_RECORD_FIELDS unsigned ints
+#   depends     dependency count pairs of (name, constraint) string indices
+#   blob        utf-8 encoded strings, each stored once
+# Packages are sorted by pkgname so lookups can bisect the records.
+def write_snapshot(packages, filename=SNAPSHOT_FILENAME):
+    strings = []
+    index = dict()
+
+    def intern(string):
+        if string not in index:
+            index[string] = len(strings)
+            strings.append(string)
+        return index[string]
+
+    records = array.array('I')
+    depends = array.array('I')
+    for pkgname in sorted(packages):
+        pkgver, pkgrel, dependencies = packages[pkgname]
+        records.extend((intern(pkgname), intern(str(pkgver)),
+                        intern(str(pkgrel)), len(depends) // 2,
+                        len(dependencies)))
+        for d in dependencies:
+            name, constraint = split_dependency(d)
+            depends.extend((intern(name), intern(constraint)))
+
+    offsets = array.array('I', [0])
+    blob = bytearray()
+    for s in strings:
+        blob += s.encode('utf-8')
+        offsets.append(len(blob))
+
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+            len(strings), len(packages), len(depends) // 2)
+
+    # Write to a temporary file first so readers never see a partial snapshot
+    fh = tempfile.NamedTemporaryFile(dir=os.path.dirname(filename) or '.',
+            prefix=os.path.basename(filename) + '.', delete=False)
+    try:
+        with fh:
+            fh.write(header)
+            offsets.tofile(fh)
+            records.tofile(fh)
+            depends.tofile(fh)
+            fh.write(blob)
+        # NamedTemporaryFile is private to its owner, give it the usual mode
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(fh.name, 0o666 & ~umask)
+        os.replace(fh.name, filename)
+    except BaseException:
+        if os.path.exists(fh.name):
+            os.remove(fh.name)
+        raise
+
+
+# Return snapshot contents as {pkgname: (pkgver, pkgrel, [depends])}
+def read_snapshot(filename=SNAPSHOT_FILENAME):
+    if not os.path.isfile(filename):
+        return dict()
+    with PackageSnapshot(filename) as snapshot:
+        return {p['pkgname']: (p['pkgver'], p['pkgrel'], p['depends'])
+                for p in snapshot.packages()}
+
+
+# Replace a single package in the snapshot, leaving the others untouched.
+# Assumes a single writer: two mkpkgbuild runs updating the same snapshot at
+# once may each write their own copy, and the last one to finish wins.
+def update_snapshot(pkgname, pkgver, pkgrel, depends,
+        filename=SNAPSHOT_FILENAME):
+    if os.path.isfile(filename):
+        packages = read_snapshot(filename)
+    else:
+        # No snapshot yet, start from every PKGBUILD already on disk
+        packages = read_pkgbuilds(os.listdir())
+    packages[pkgname] = (pkgver, pkgrel, split_array(depends))
+    write_snapshot(packages, filename)
+
+
+# Create a snapshot from existing PKGBUILDs, e.g. build_snapshot(os.listdir())
+def build_snapshot(pkgnames, filename=SNAPSHOT_FILENAME):
+    write_snapshot(read_pkgbuilds(pkgnames), filename)
+
+
+# Return existing PKGBUILDs as {pkgname: (pkgver, pkgrel, [depends])}
+def read_pkgbuilds(pkgnames):
+    packages = dict()
+    for pkgname in pkgnames:
+        if not os.path.isfile(pkgname + '/PKGBUILD'):
+            continue
+        pkgbuild = read_pkgbuild(pkgname)
+        packages[pkgbuild.get('pkgname', pkgname)] = (
+                pkgbuild.get('pkgver', ''), pkgbuild.get('pkgrel', ''),
+                split_array(pkgbuild.get('depends')))
+    return packages
+
+
+# Read-only, memory-mapped view of a snapshot written by write_snapshot.
+# Nothing is copied out of the mapping until a string is asked for.
+class PackageSnapshot:
+    def __init__(self, filename=SNAPSHOT_FILENAME):
+        with open(filename, 'rb') as fh:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        try:
+            (magic, version, string_count, package_count,
+                    depends_count) = SNAPSHOT_HEADER.unpack_from(self._view)
+        except struct.error:
+            self.close()
+            raise ValueError('truncated snapshot %r' % (filename,))
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            self.close()
+            raise ValueError('not a version %d snapshot: %r'
+                    % (SNAPSHOT_VERSION, filename))
+
+        counts = (string_count + 1,
+                  package_count * SNAPSHOT_RECORD_FIELDS,
+                  depends_count * 2)
+        if len(self._view) < SNAPSHOT_HEADER.size + 4 * sum(counts):
+            self.close()
+            raise ValueError('truncated snapshot %r' % (filename,))
+
+        start = SNAPSHOT_HEADER.size
+        sections = []
+        for count in counts:
+            end = start + count * 4
+            sections.append(self._view[start:end].cast('I'))
+            start = end
+        self._offsets, self._records, self._depends = sections
+        self._blob = self._view[start:]
+        self._count = package_count
+        if not self._valid(string_count, depends_count):
+            self.close()
+            raise ValueError('corrupt snapshot %r' % (filename,))
+
+    # Check that every offset and index points inside the snapshot, so
+    # queries never have to
+    def _valid(self, string_count, depends_count):
+        previous = 0
+        for offset in self._offsets:
+            if offset < previous:
+                return False
+            previous = offset
+        if previous > len(self._blob):
+            return False
+        for n in range(self._count):
+            name, pkgver, pkgrel, first, count = self._record(n)
+            if max(name, pkgver, pkgrel) >= string_count:
+                return False
+            if first + count > depends_count:
+                return False
+        return all(i < string_count for i in self._depends)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        # Views into the mapping must be released before it can be closed
+        for name in ('_offsets', '_records', '_depends', '_blob', '_view'):
+            view = self.__dict__.pop(name, None)
+            if view is not None:
+                view.release()
+        self._map.close()
+
+    def _bytes(self, i):
+        return self._blob[self._offsets[i]:self._offsets[i + 1]]
+
+    def _string(self, i):
+        return str(self._bytes(i), 'utf-8')
+
+    def _record(self, n):
+        start = n * SNAPSHOT_RECORD_FIELDS
+        return self._records[start:start + SNAPSHOT_RECORD_FIELDS]
+
+    def _find(self, pkgname):
+        target = pkgname.encode('utf-8')
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._bytes(self._record(middle)[0]).tobytes() < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self._bytes(self._record(low)[0]) == target:
+            return low
+        return None
+
+    def _package(self, n):
+        name, pkgver, pkgrel, first, count = self._record(n)
+        depends = []
+        for d in range(first, first + count):
+            depends.append(self._string(self._depends[2 * d]) +
+                           self._string(self._depends[2 * d + 1]))
+        return dict(pkgname = self._string(name),
+                    pkgver  = self._string(pkgver),
+                    pkgrel  = self._string(pkgrel),
+                    depends = depends)
+
+    # Return all package names, sorted
+    def names(self):
+        return [self._string(self._record(n)[0]) for n in range(self._count)]
+
+    # Return a dict of pkgname, pkgver, pkgrel and depends, or None
+    def get(self, pkgname):
+        n = self._find(pkgname)
+        return None if n is None else self._package(n)
+
+    # Return pkgver for pkgname, or None
+    def version(self, pkgname):
+        n = self._find(pkgname)
+        return None if n is None else self._string(self._record(n)[1])
+
+    # Return names of packages depending on dependency, version ignored
+    def dependents(self, dependency):
+        target = dependency.encode('utf-8')
+        result = []
+        for n in range(self._count):
+            name, pkgver, pkgrel, first, count = self._record(n)
+            for d in range(first, first + count):
+                if self._bytes(self._depends[2 * d]) == target:
+                    result.append(self._string(name))
+                    break
+        return result
+
+    # Yield every package as returned by get()
+    def packages(self):
+        for n in range(self._count):
+            yield self._package(n)
+
+
+# Compare querying every package through the snapshot with re-parsing
+# every PKGBUILD, e.g. benchmark_snapshot(os.listdir()). The snapshot is
+# built in a temporary file, the real one is left alone.
+def benchmark_snapshot(pkgnames, number=10):
+    pkgnames = [p for p in pkgnames if os.path.isfile(p + '/PKGBUILD')]
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, SNAPSHOT_FILENAME)
+        build_snapshot(pkgnames, filename)
+        parsed, queried = time_snapshot(pkgnames, number, filename)
+    print("{0} packages".format(len(pkgnames)))
+    print("  read_pkgbuild:   {0:.6f} s".format(parsed))
+    print("  PackageSnapshot: {0:.6f} s".format(queried))
+    if queried:
+        print("  Speedup:         {0:.1f}x".format(parsed / queried))
+
+
+# Return average seconds per pass for re-parsing and for the snapshot
+def time_snapshot(pkgnames, number, filename):
+    def parse():
+        for pkgname in pkgnames:
+            pkgbuild = read_pkgbuild(pkgname)
+            pkgbuild.get('pkgver'), split_array(pkgbuild.get('depends'))
+
+    def query():
+        with PackageSnapshot(filename) as snapshot:
+            for pkgname in pkgnames:
+                snapshot.get(pkgname)
+
+    return (timeit.timeit(parse, number=number) / number,
+            timeit.timeit(query, number=number) / number)
+
+
 # TODO Print previous value\n, scraped value\n, input [default value]:
 def get_string(message, name='string', default=None,
         minimum_length=0, maximum_length=128):
@@ -652,4 +974,13 @@ def get_string(message, name='string', default=None,
 #     print("  Existing PKGBUILD found in ./" + pkgname + "/PKGBUILD:")
 #     print(exists)
 
-main()
+if __name__ == '__main__':
+    if sys.argv[1:] == ['snapshot']:
+        build_snapshot(os.listdir())
+        print("Saved", SNAPSHOT_FILENAME)
+    elif sys.argv[1:] == ['benchmark']:
+        benchmark_snapshot(os.listdir())
+    elif sys.argv[1:]:
+        sys.exit("usage: mkpkgbuild.py [snapshot | benchmark]")
+    else:
+        main()
@@ -0,0 +1,125 @@
+import array
+import os
+
+import pytest
+
+import mkpkgbuild
+from mkpkgbuild import (PackageSnapshot, SNAPSHOT_HEADER, read_snapshot,
+        update_snapshot, write_snapshot)
+
+
+PACKAGES = {
+    'haskell-mtl': ('2.1.2', '3', ['ghc=7.6.3-1',
+                                   'haskell-transformers>=0.3']),
+    'haskell-transformers': ('0.3.0.0', '1', ['ghc=7.6.3-1']),
+    'haskell-tovetjärn': ('1.0', '1', []),
+    'haskell-xmonad': ('0.11', '2', ['haskell-mtl', 'haskell-x11<1.7']),
+}
+
+
+@pytest.fixture
+def snapshot_file(tmp_path):
+    filename = str(tmp_path / mkpkgbuild.SNAPSHOT_FILENAME)
+    write_snapshot(PACKAGES, filename)
+    return filename
+
+
+def corrupt(filename, index, value):
+    # Overwrite the index-th unsigned int after the header
+    with open(filename, 'r+b') as fh:
+        fh.seek(SNAPSHOT_HEADER.size + 4 * index)
+        array.array('I', [value]).tofile(fh)
+
+
+def test_round_trip(snapshot_file):
+    with PackageSnapshot(snapshot_file) as snapshot:
+        assert len(snapshot) == len(PACKAGES)
+        assert snapshot.names() == sorted(PACKAGES)
+        for pkgname, (pkgver, pkgrel, depends) in PACKAGES.items():
+            assert snapshot.get(pkgname) == dict(pkgname=pkgname,
+                    pkgver=pkgver, pkgrel=pkgrel, depends=depends)
+    assert read_snapshot(snapshot_file) == PACKAGES
+
+
+def test_missing_package(snapshot_file):
+    with PackageSnapshot(snapshot_file) as snapshot:
+        assert snapshot.get('haskell-zlib') is None
+        assert snapshot.version('haskell-zlib') is None
+        assert snapshot.get('') is None
+        assert snapshot.version('haskell-mtl') == '2.1.2'
+
+
+def test_dependents(snapshot_file):
+    with PackageSnapshot(snapshot_file) as snapshot:
+        assert snapshot.dependents('ghc') == ['haskell-mtl',
+                                              'haskell-transformers']
+        assert snapshot.dependents('haskell-x11') == ['haskell-xmonad']
+        assert snapshot.dependents('haskell-zlib') == []
+
+
+def test_truncated(snapshot_file):
+    size = os.path.getsize(snapshot_file)
+    for length in (0, 2, SNAPSHOT_HEADER.size, size - 40):
+        with open(snapshot_file, 'r+b') as fh:
+            fh.truncate(length)
+        with pytest.raises(ValueError):
+            PackageSnapshot(snapshot_file)
+
+
+def test_wrong_magic(snapshot_file):
+    with open(snapshot_file, 'r+b') as fh:
+        fh.write(b'NOPE')
+    with pytest.raises(ValueError):
+        PackageSnapshot(snapshot_file)
+
+
+@pytest.mark.parametrize('section', ['offset', 'record', 'first', 'depends'])
+def test_out_of_range_index(snapshot_file, section):
+    with PackageSnapshot(snapshot_file) as snapshot:
+        strings = len(snapshot._offsets)
+        records = len(snapshot._records)
+    index = dict(offset=1,
+                 record=strings,
+                 first=strings + 3,
+                 depends=strings + records)[section]
+    corrupt(snapshot_file, index, 0xffff)
+    with pytest.raises(ValueError):
+        PackageSnapshot(snapshot_file)
+
+
+def test_update_replaces_single_package(snapshot_file):
+    update_snapshot('haskell-mtl', '2.2', '1', "'ghc=7.6.3-1'", snapshot_file)
+    packages = dict(PACKAGES)
+    packages['haskell-mtl'] = ('2.2', '1', ['ghc=7.6.3-1'])
+    assert read_snapshot(snapshot_file) == packages
+    assert os.listdir(os.path.dirname(snapshot_file)) == [
+            mkpkgbuild.SNAPSHOT_FILENAME]
+
+
+def test_update_bootstraps_from_pkgbuilds(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for pkgname in ('haskell-mtl', 'haskell-text'):
+        os.mkdir(pkgname)
+        with open(pkgname + '/PKGBUILD', 'w') as fh:
+            fh.write("pkgname={0}\npkgver=1.0\npkgrel=2\n"
+                     "depends=('ghc=7.6.3-1')\n".format(pkgname))
+    update_snapshot('haskell-zlib', '0.5', '1', '')
+    assert read_snapshot() == {
+        'haskell-mtl': ('1.0', '2', ['ghc=7.6.3-1']),
+        'haskell-text': ('1.0', '2', ['ghc=7.6.3-1']),
+        'haskell-zlib': ('0.5', '1', []),
+    }
+
+
+def test_write_pkgbuild_rebuilds_corrupt_snapshot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_snapshot(PACKAGES)
+    corrupt(mkpkgbuild.SNAPSHOT_FILENAME, 1, 0xffff)
+    information = dict.fromkeys(['date', 'repository', 'maintainer_name',
+            'maintainer_alias', 'maintainer_email', 'pkgdesc', 'arch',
+            'license', 'groups', 'optdepends', 'makedepends', 'checkdepends',
+            'provides', 'conflicts', 'replaces', 'options', 'checksum'], '')
+    os.mkdir('haskell-zlib')
+    mkpkgbuild.write_pkgbuild(_hkgname='zlib', pkgname='haskell-zlib',
+            pkgver='0.5', pkgrel='1', depends="'ghc=7.6.3-1'", **information)
+    assert read_snapshot() == {'haskell-zlib': ('0.5', '1', ['ghc=7.6.3-1'])}